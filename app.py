@@ -1,14 +1,24 @@
 import dash
-from dash import Dash, dcc, html, Input, Output, State
+from dash import Dash, dcc, html, Input, Output, State, CeleryManager
 import dash_bootstrap_components as dbc
 import pandas as pd
+import pyarrow as pa
 import plotly.express as px
+import plotly.graph_objects as go
 import io
 import base64
+import hashlib
+import orjson
 import os
+import tempfile
+import threading
 import plotly.io as pio
-import kaleido  # required by plotly.io.write_image
+import kaleido  # required by plotly.io.to_image
+from flask import request
+from flask_caching import Cache
 from datetime import datetime
+from collections import OrderedDict
+from functools import lru_cache
 
 external_stylesheets = [
     dbc.themes.FLATLY,
@@ -16,6 +26,19 @@ external_stylesheets = [
 ]
 
 
+# Serialize figures with orjson: Dash encodes callback responses (and the initial layout)
+# through plotly's JSON encoder, which then runs in native code
+pio.json.config.default_engine = "orjson"
+
+# Static export settings: 900x600 at scale 2 -> 1800x1200 px PNG.
+# Newer plotly versions moved these defaults from the Kaleido scope to pio.defaults.
+export_defaults = pio.defaults if hasattr(pio, "defaults") else pio.kaleido.scope
+export_defaults.default_format = "png"
+export_defaults.default_width = 900
+export_defaults.default_height = 600
+export_defaults.default_scale = 2
+
+
 # Fallback sample data in case Excel is missing or empty
 fallback_data = pd.DataFrame({
     "Name of IRO": [
@@ -31,102 +54,367 @@ fallback_data = pd.DataFrame({
     ]
 })
 
-# Try loading the default template
+REQUIRED_COLS = ["Name of IRO", "Impact", "Risk", "Sub-Topic"]
+
+
+# Compact dtypes for plotting: integer scores downcast (int8 for 1-5) and Sub-Topic as a
+# category, so per-label work and hashing run per distinct Sub-Topic rather than per row
+def compact_frame(df):
+    scores = {col: pd.to_numeric(df[col], downcast="integer")
+              for col in ("Impact", "Risk") if pd.api.types.is_numeric_dtype(df[col])}
+    return df.assign(**scores, **{"Sub-Topic": label_strings(df["Sub-Topic"]).astype("category")})
+
+
 TEMPLATE_PATH = os.path.join("data", "Materiality_Template.xlsx")
+# Arrow copy of the template, written on first start (or when the xlsx changes) so later
+# worker boots memory-map it instead of parsing the workbook
+TEMPLATE_ARROW_PATH = os.path.join("data", "Materiality_Template.arrow")
+
+
+def load_template():
+    if (not os.path.exists(TEMPLATE_ARROW_PATH)
+            or os.path.getmtime(TEMPLATE_ARROW_PATH) < os.path.getmtime(TEMPLATE_PATH)):
+        df = pd.read_excel(TEMPLATE_PATH)
+        tmp_path = f"{TEMPLATE_ARROW_PATH}.{os.getpid()}.tmp"
+        # the Arrow copy is only a speed-up: if it can't be built (read-only dir, or a
+        # column Arrow can't type) the parsed workbook is used as is
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_path, TEMPLATE_ARROW_PATH)  # atomic, safe with several workers booting
+        except (pa.ArrowException, OSError) as e:
+            print(f"Could not write {TEMPLATE_ARROW_PATH}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return df
+    return pa.ipc.open_file(pa.memory_map(TEMPLATE_ARROW_PATH, "r")).read_all().to_pandas()
+
+
+# Try loading the default template
 try:
-    df_default = pd.read_excel(TEMPLATE_PATH)
-    if df_default.empty or not {"Name of IRO", "Impact", "Risk", "Sub-Topic"}.issubset(df_default.columns):
+    df_default = load_template()
+    if df_default.empty or not set(REQUIRED_COLS).issubset(df_default.columns):
         df_default = fallback_data
 except Exception as e:
     print(f"Failed to load Excel file: {e}")
     df_default = fallback_data
+df_default = compact_frame(df_default)
+
+
+# Parse an uploaded workbook, keeping only the columns the plot uses.
+# python-calamine is much faster than openpyxl; openpyxl remains the fallback.
+def read_upload(decoded):
+    usecols = lambda col: col in REQUIRED_COLS
+    try:
+        return pd.read_excel(io.BytesIO(decoded), engine="calamine", usecols=usecols)
+    except Exception:
+        return pd.read_excel(io.BytesIO(decoded), engine="openpyxl", usecols=usecols)
+
 
-# Function to generate the plot
+# Figures already built, keyed by (company_name, DataFrame fingerprint)
+# (LRU; shared by the worker's threads, so every access goes through the lock)
+FIGURE_CACHE_SIZE = 32
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+
+# hash_pandas_object hashes values by column position only, so the column names and dtypes
+# go into the key too (swapped Risk/Impact columns must not share a figure)
+def df_fingerprint(df):
+    return (tuple(df.columns), tuple(str(dtype) for dtype in df.dtypes),
+            pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+
+# Function to generate the plot (cached: identical data + company name reuse the same figure)
 def generate_figure(df, company_name=""):
+    key = (company_name, df_fingerprint(df))
+    with _figure_cache_lock:
+        fig = _figure_cache.get(key)
+        if fig is not None:
+            _figure_cache.move_to_end(key)
+            return fig
+    # built outside the lock so concurrent misses for different data don't wait on each other
+    fig = _build_figure(df, company_name)
+    with _figure_cache_lock:
+        _figure_cache[key] = fig
+        _figure_cache.move_to_end(key)
+        while len(_figure_cache) > FIGURE_CACHE_SIZE:
+            _figure_cache.popitem(last=False)  # drop the least recently used entry
+    return fig
 
-    if "Sub-Topic" in df.columns:
-        def wrap_label(text):
-            clean = str(text).replace("_", " ")
-            words = clean.split()
-            # break into lines of 4 words
-            lines = [' '.join(words[i:i + 4]) for i in range(0, len(words), 4)]
-            return '<br>'.join(lines)
-
-        df["Sub-Topic"] = df["Sub-Topic"].apply(wrap_label)
-
-    title_text = f"<b>{company_name} : Double Materiality Map</b>" if company_name else "<b>Double Materiality Map</b>"
-
-    fig = px.scatter(
-        df,
-        x="Risk",
-        y="Impact",
-        color="Sub-Topic",
-        hover_name="Name of IRO",
-        title=title_text
+
+# Labels as strings, blanks included: missing values become "nan" (what str() gave per row)
+# explicitly, since astype(str) keeps NaN on pandas' str dtype and groupby would drop those rows
+def label_strings(labels):
+    return labels.astype(object).where(labels.notna(), "nan").astype(str)
+
+
+# Memoized: the same Sub-Topic labels recur across uploads and figures
+@lru_cache(maxsize=1024)
+def wrap_label(text):
+    clean = str(text).replace("_", " ")
+    words = clean.split()
+    # break into lines of 4 words
+    lines = [' '.join(words[i:i + 4]) for i in range(0, len(words), 4)]
+    return '<br>'.join(lines)
+
+
+# Vectorized wrap_label over a column: string cleanup runs in pandas, and only labels
+# longer than 4 words are wrapped in Python, once per distinct value
+def wrap_labels(labels):
+    if isinstance(labels.dtype, pd.CategoricalDtype):
+        # wrap the categories once and map them back onto the codes
+        categories = labels.cat.categories
+        return labels.map(dict(zip(categories, wrap_labels(pd.Series(categories, dtype=object)))))
+    clean = (label_strings(labels)
+             .str.replace("_", " ", regex=False)
+             .str.replace(r"\s+", " ", regex=True)
+             .str.strip())
+    long = clean.str.count(" ") >= 4
+    if long.any():
+        wrapped = {text: wrap_label(text) for text in clean[long].unique()}
+        clean[long] = clean[long].map(wrapped)
+    return clean
+
+
+def figure_title(company_name):
+    return f"<b>{company_name} : Double Materiality Map</b>" if company_name else "<b>Double Materiality Map</b>"
+
+
+# Static part of the figure layout, validated once at import and kept as a plain dict;
+# figures only swap in their title
+_LAYOUT = go.Layout(
+    template='simple_white',
+    autosize=False,
+    height=620,
+    width=850,
+    uirevision='static',
+    margin=dict(l=40, r=40, t=60, b=60),
+    font=dict(size=18, family="Arial", color="#333"),
+    title_font=dict(size=20, family="Arial", color="#333"),
+    title_x=0.25,  # Center the title relative to the graph
+    legend=dict(
+        font=dict(size=18),
+        title=dict(text="<b>Sub-Topic<br>", font=dict(size=19), side="top"),
+        x=1.1,
+        xanchor='left',
+        y=1.0,
+        yanchor='top',
+        tracegroupgap=0  # px default; each Sub-Topic is its own legend group
+    ),
+    xaxis=dict(
+        title="Financial Materiality (Risk or Opportunity)",
+        range=[0, 5.1],         # lock x-axis
+        fixedrange=True,      # no zooming or panning
+        tickmode='array',
+        tickvals=[1, 2, 3, 4, 5],  # Show only 1–5
+        ticktext=["1", "2", "3", "4", "5"],
+        gridcolor='lightgray',
+        gridwidth=0.5,
+        showgrid=True,
+        scaleanchor="y",
+        layer='below traces'
+    ),
+    yaxis=dict(
+        title="Impact Materiality",
+        range=[0, 5.1],         # lock y-axis
+        fixedrange=True,      # no zooming or panning
+        tickmode='array',
+        tickvals=[1, 2, 3, 4, 5],  # Show only 1–5
+        ticktext=["1", "2", "3", "4", "5"],
+        gridcolor='lightgray',
+        gridwidth=1,
+        showgrid=True,
+        layer='below traces'
     )
+).to_plotly_json()
+
+
+# Above MAX_POINTS rows, IROs sharing a Sub-Topic and position are merged into one marker
+# (they would be drawn on top of each other anyway) and the hover lists the merged names.
+# On the usual integer 1-5 scores that alone keeps traces small; fractional scores can still
+# leave many distinct positions, so each trace is then capped at MAX_POINTS
+MAX_POINTS = 2000
+MAX_HOVER_NAMES = 10
+
+
+def merge_overlapping(df):
+    def join_names(names):
+        names = names.astype(str)
+        text = "<br>".join(names.iloc[:MAX_HOVER_NAMES])
+        if len(names) > MAX_HOVER_NAMES:
+            text += f"<br>... and {len(names) - MAX_HOVER_NAMES} more"
+        return text
+
+    return (df.groupby(["Sub-Topic", "Risk", "Impact"], sort=False, observed=True)["Name of IRO"]
+            .agg(join_names)
+            .reset_index())
+
+
+# At most MAX_POINTS markers per Sub-Topic, picked by a fixed-seed shuffle (same data, same figure)
+def cap_points(df):
+    shuffled = df.sample(frac=1, random_state=0)
+    kept = shuffled[shuffled.groupby("Sub-Topic", sort=False, observed=True).cumcount() < MAX_POINTS]
+    return kept.sort_index()
+
+
+# Same per-Sub-Topic colours px.scatter assigned (its default palette, not the template's colorway)
+MARKER_COLORS = px.colors.qualitative.Plotly
+
 
-    fig.update_traces(marker=dict(
-        size=12,
-        line=dict(width=0),  # no border
-        opacity=1.0
-    ), selector=dict(mode='markers'))
-
-    fig.update_layout(
-        template='simple_white',
-        autosize=False,
-        height=620,
-        width=850,
-        uirevision='static',
-        margin=dict(l=40, r=40, t=60, b=60),
-        font=dict(size=18, family="Arial", color="#333"),
-        title_font=dict(size=20, family="Arial", color="#333"),
-        title_x=0.25,  # Center the title relative to the graph
-        legend=dict(
-            font=dict(size=18),
-            title=dict(text="<b>Sub-Topic<br>", font=dict(size=19), side="top"),
-            x=1.1,
-            xanchor='left',
-            y=1.0,
-            yanchor='top'
-        ),
-        xaxis=dict(
-            title="Financial Materiality (Risk or Opportunity)",
-            range=[0, 5.1],         # lock x-axis
-            fixedrange=True,      # no zooming or panning
-            tickmode='array',
-            tickvals=[1, 2, 3, 4, 5],  # Show only 1–5
-            ticktext=["1", "2", "3", "4", "5"],
-            gridcolor='lightgray',
-            gridwidth=0.5,
-            showgrid=True,
-            scaleanchor="y",
-            layer='below traces'
-        ),
-        yaxis=dict(
-            title="Impact Materiality",
-            range=[0, 5.1],         # lock y-axis
-            fixedrange=True,      # no zooming or panning
-            tickmode='array',
-            tickvals=[1, 2, 3, 4, 5],  # Show only 1–5
-            ticktext=["1", "2", "3", "4", "5"],
-            gridcolor='lightgray',
-            gridwidth=1,
-            showgrid=True,
-            layer='below traces'
+def _build_figure(df, company_name):
+
+    # wrapped labels go on a new frame; the caller's DataFrame is never modified
+    if "Sub-Topic" in df.columns:
+        df = df.assign(**{"Sub-Topic": wrap_labels(df["Sub-Topic"])})
+
+    if len(df) > MAX_POINTS:
+        df = cap_points(merge_overlapping(df))
+
+    title_text = figure_title(company_name)
+
+    # One WebGL trace per Sub-Topic, built directly instead of through plotly.express
+    traces = [
+        go.Scattergl(
+            x=group["Risk"].values,
+            y=group["Impact"].values,
+            mode="markers",
+            name=name,
+            legendgroup=name,
+            showlegend=True,  # keep the legend even for a single Sub-Topic
+            hovertext=group["Name of IRO"].values,
+            hovertemplate=f"<b>%{{hovertext}}</b><br><br>Sub-Topic={name}<br>Risk=%{{x}}<br>Impact=%{{y}}<extra></extra>",
+            marker=dict(
+                size=12,
+                color=MARKER_COLORS[i % len(MARKER_COLORS)],
+                line=dict(width=0),  # no border
+                opacity=1.0
+            )
         )
-    )
+        for i, (name, group) in enumerate(df.groupby("Sub-Topic", sort=False, observed=True))
+    ]
 
-    return fig
+    # the title goes straight into the constructor: no update_layout merge afterwards
+    layout = dict(_LAYOUT, title=dict(_LAYOUT["title"], text=title_text))
+
+    return go.Figure(data=traces, layout=layout)
+
+
+# Kaleido 1.x launches a fresh Chromium for every export unless its sync server is running.
+# It is started lazily, on the first download in each process (so Celery workers and workers
+# that never export don't start a browser), and renders are serialised: the server hands
+# results back through a single shared queue. Kaleido 0.x keeps its scope process alive on its own.
+_kaleido_lock = threading.Lock()
+_kaleido_pid = None  # process that started the sync server; its thread doesn't survive a fork
+_kaleido_failed = False
+
+
+def _kaleido_server_alive():
+    # kaleido reports is_running() even after its server thread has died, so check the thread itself
+    thread = getattr(getattr(kaleido, "_global_server", None), "_thread", None)
+    return _kaleido_pid == os.getpid() and thread is not None and thread.is_alive()
+
+
+def _start_kaleido_server():
+    global _kaleido_pid, _kaleido_failed
+    server = getattr(kaleido, "_global_server", None)
+    if server is not None:
+        server._initialized = False  # drop state left by a dead thread or the parent process
+    try:
+        kaleido.start_sync_server()
+        _kaleido_pid = os.getpid()
+        # startup errors (e.g. Chrome not found) end the thread instead of raising here
+        server = getattr(kaleido, "_global_server", None)
+        server._thread.join(timeout=0.5)
+        if not _kaleido_server_alive():
+            raise RuntimeError("Kaleido sync server stopped during startup")
+    except Exception as e:
+        print(f"Kaleido sync server unavailable, exporting without it: {e}")
+        _kaleido_failed = True
+        if server is not None:
+            server._initialized = False  # so plotly falls back to one-shot exports
+
+
+# Rendered PNG bytes, keyed by the figure JSON, so repeat downloads skip Kaleido
+@lru_cache(maxsize=32)
+def render_png(fig_json):
+    with _kaleido_lock:
+        if hasattr(kaleido, "start_sync_server") and not _kaleido_failed and not _kaleido_server_alive():
+            _start_kaleido_server()
+        # explicit size: the figure layout carries its own on-screen width/height
+        return pio.to_image(pio.from_json(fig_json), width=export_defaults.default_width,
+                            height=export_defaults.default_height)
+
+
+# The default-data figure never changes: build it once at import as a plain dict and serve it as is
+DEFAULT_FIGURE = generate_figure(df_default).to_plotly_json()
 
 
+# With REDIS_URL set, uploads are parsed on a Celery worker (celery -A app:celery_app worker)
+# instead of blocking a web worker; without it they run in-process as before.
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    from celery import Celery
+    celery_app = Celery(__name__, broker=REDIS_URL, backend=REDIS_URL)
+    background_callback_manager = CeleryManager(celery_app)
+else:
+    background_callback_manager = None
+
 # Dash app init
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
+                background_callback_manager=background_callback_manager)
 app.title = "DMM"
 app.config.suppress_callback_exceptions = True
 
+# Parsed uploads, shared by the workers on this host.
+# For several hosts set CACHE_TYPE=RedisCache and REDIS_URL.
+cache = Cache(app.server, config={
+    "CACHE_TYPE": os.environ.get("CACHE_TYPE", "FileSystemCache"),
+    "CACHE_DIR": os.environ.get("CACHE_DIR", os.path.join(tempfile.gettempdir(), "dmm-cache")),
+    "CACHE_REDIS_URL": REDIS_URL or "",
+    "CACHE_DEFAULT_TIMEOUT": 3600
+})
+
+
+# read_upload memoized by content hash, so re-uploading the same file skips the xlsx parse
+def parse_upload(decoded):
+    key = "upload-" + hashlib.blake2b(decoded, digest_size=16).hexdigest()
+    df = cache.get(key)
+    if df is None:
+        df = read_upload(decoded)
+        cache.set(key, df)
+    return df
+
+
+# Route Dash serves assets from, honouring a URL prefix and a custom assets_url_path
+ASSETS_ROUTE = f"{app.config.routes_pathname_prefix}{app.config.assets_url_path.strip('/')}/"
+
+
+# Static assets: URLs carrying an "m" fingerprint (Dash adds one to its CSS/JS, versioned_asset to
+# the rest) change whenever the file does, so browsers may keep them for a year without revalidating
+@app.server.after_request
+def cache_assets(response):
+    # successful responses and revalidations (a 304's headers replace the cached ones);
+    # a 404 for a missing asset must not be cached
+    if response.status_code in (200, 304) and request.path.startswith(ASSETS_ROUTE):
+        if "m" in request.args:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+
+def versioned_asset(path):
+    mtime = int(os.path.getmtime(os.path.join(app.config.assets_folder, path)))
+    return f"{app.get_asset_url(path)}?m={mtime}"
+
+
+GRAPH_STYLE = {"height": "100%", "width": "100%", "marginTop": "60px"}
+
 # Layout
 app.layout = dbc.Container([
-    html.Img(src='/assets/bm.jpeg', className='logo'),
+    html.Img(src=versioned_asset('bm.jpeg'), className='logo'),
 
     html.H2("Bemari : Double Materiality Map", className="mt-4 mb-4 text-center"),
 
@@ -226,50 +514,75 @@ app.layout = dbc.Container([
 
     html.Div([
         html.Div(
-            dcc.Graph(id='scatter-plot', figure=generate_figure(df_default),
-                      style={"height": "100%", "width": "100%", "marginTop": "60px"}),
+            dcc.Graph(id='scatter-plot', figure=DEFAULT_FIGURE, style=GRAPH_STYLE),
             className="graph-container"
         )
     ], className="graph-wrapper")
 ], fluid=True)
 
-# Callback for file upload
+# Callback for file upload: the only path that rebuilds the whole figure
 @app.callback(
     Output('scatter-plot', 'figure'),
     Input('upload-data', 'contents'),
-    Input('input-company', 'value'),
-    State('upload-data', 'filename')
+    State('input-company', 'value'),
+    State('upload-data', 'filename'),
+    background=background_callback_manager is not None,
+    # dim the graph while the upload is processed
+    running=[(Output('scatter-plot', 'style'), {**GRAPH_STYLE, "opacity": 0.5}, GRAPH_STYLE)],
+    prevent_initial_call=True  # the layout already holds DEFAULT_FIGURE
 )
 
 def update_graph(contents, company_name, filename):
     if contents is None:
-        return generate_figure(df_default, company_name or "")
+        return generate_figure(df_default, company_name) if company_name else DEFAULT_FIGURE
 
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+    # data URL "data:<type>;base64,<payload>": slice the payload out without building a list
+    decoded = base64.b64decode(contents[contents.index(',') + 1:])
     try:
-        df = pd.read_excel(io.BytesIO(decoded))
-        required_cols = {"Name of IRO", "Impact", "Risk", "Sub-Topic"}
-        if not required_cols.issubset(df.columns):
+        df = parse_upload(decoded)
+        if not set(REQUIRED_COLS).issubset(df.columns):
             return px.scatter(title="Missing required columns: Name of IRO, Impact, Risk, Sub-Topic")
-        return generate_figure(df, company_name or "")
+        return generate_figure(compact_frame(df), company_name or "")
     except Exception as e:
         return px.scatter(title=f"Error reading file: {str(e)}")
 
+
+# Company name only changes the title: updated in the browser, no server round-trip.
+# Also runs when a new figure arrives, so an upload that finishes after the name was edited
+# gets the current title rather than the one read when the upload started.
+# The title format mirrors figure_title(); figures with another title (errors) are left alone.
+app.clientside_callback(
+    """
+    function(companyName, figure) {
+        const current = figure && figure.layout && figure.layout.title && figure.layout.title.text;
+        const text = companyName ? `<b>${companyName} : Double Materiality Map</b>` : '<b>Double Materiality Map</b>';
+        if (!current || !current.endsWith('Double Materiality Map</b>') || current === text) {
+            return window.dash_clientside.no_update;
+        }
+        const title = Object.assign({}, figure.layout.title, {text: text});
+        return Object.assign({}, figure, {layout: Object.assign({}, figure.layout, {title: title})});
+    }
+    """,
+    Output('scatter-plot', 'figure', allow_duplicate=True),
+    Input('input-company', 'value'),
+    Input('scatter-plot', 'figure'),
+    prevent_initial_call=True
+)
+
+
 @app.callback(
     Output("download-fig", "data"),
     Input("btn-download-fig", "n_clicks"),
     State("input-company", "value"),
+    State("scatter-plot", "figure"),
     prevent_initial_call=True
 )
-def download_chart(n_clicks, company_name):
-    fig = generate_figure(df_default, company_name or "")
+def download_chart(n_clicks, company_name, current_figure):
+    # Export what is on screen instead of rebuilding a figure from the default data
+    png = render_png(orjson.dumps(current_figure, option=orjson.OPT_SORT_KEYS).decode())
     filename = f"materiality_map_{(company_name or 'company').lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.png"
-    return dcc.send_bytes(lambda: fig.to_image(format="png", width=900, height=600, scale=2), filename)
-
+    return dcc.send_bytes(png, filename)
 
-test_fig = generate_figure(df_default)
-# test_fig.write_image("test_plot.png")
 
 # if __name__ == '__main__':
 #     app.run(debug=True)